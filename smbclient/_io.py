@@ -124,7 +124,7 @@ def _chunk_size(connection, length, operation):
 
     # Determine the maximum data length we can send for the operation. We do this by checking the available credits and
     # calculating whatever is the smallest; length, negotiated operation size, available credit size).
-    available_credits = connection.sequence_window['high'] - connection.sequence_window['low']
+    available_credits = connection.sequence_window_high - connection.sequence_window_low
     chunk_size = min(length, max_size, available_credits * MAX_PAYLOAD_SIZE)
 
     # Determine how many credits we need to fully optimize subsequent calls for the remaining amount of data. Basically
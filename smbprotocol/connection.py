@@ -13,8 +13,10 @@ import os
 import struct
 import time
 import threading
+import warnings
 
 from collections import (
+    deque,
     OrderedDict,
 )
 
@@ -89,12 +91,21 @@ from smbprotocol.transport import (
 )
 
 try:
-    from queue import Queue, Empty
+    from collections.abc import MutableMapping
 except ImportError:  # pragma: no cover
-    from Queue import Queue, Empty
+    from collections import MutableMapping
 
 log = logging.getLogger(__name__)
 
+# The fixed 64 byte SMB2 sync/async header layout, see SMB2HeaderResponse and SMB2HeaderAsync. Fields are protocol_id,
+# structure_size, credit_charge, status, command, credit_response, flags, next_command, message_id, async_id (or
+# reserved + tree_id), session_id, and signature.
+_SMB2_HEADER_STRUCT = struct.Struct("<4sHHLHHLLQ8sQ16s")
+
+# The SMB2 TRANSFORM_HEADER fields from nonce to session_id, this is the AAD used when encrypting/decrypting a message.
+# Fields are nonce, original_message_size, reserved, flags, and session_id.
+_SMB2_TRANSFORM_AAD_STRUCT = struct.Struct("<16sLHHQ")
+
 
 class SecurityMode(object):
     """
@@ -610,6 +621,58 @@ class SMB2TransformHeader(Structure):
         super(SMB2TransformHeader, self).__init__()
 
 
+def _hmac_sha256_contexts(key):
+    """
+    Creates the SHA256 hash objects seeded with the HMAC inner (key ^ ipad) and outer (key ^ opad) padded keys. Copying
+    these for each message is cheaper than copying a full hmac object as the key padding is only done once.
+
+    :param key: The HMAC key.
+    :return: A tuple of the inner and outer SHA256 hash objects.
+    """
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = bytearray(key.ljust(64, b"\x00"))
+
+    inner = hashlib.sha256(bytes(bytearray(b ^ 0x36 for b in key)))
+    outer = hashlib.sha256(bytes(bytearray(b ^ 0x5C for b in key)))
+    return inner, outer
+
+
+class _SequenceWindow(MutableMapping):
+    """
+    The dict like view returned by the deprecated Connection.sequence_window. The low and high keys read and write
+    through to the connection's sequence_window_low and sequence_window_high attributes.
+    """
+
+    _KEYS = ('low', 'high')
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self._connection, 'sequence_window_%s' % key)
+
+    def __setitem__(self, key, value):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        with self._connection.sequence_lock:
+            setattr(self._connection, 'sequence_window_%s' % key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("Cannot delete the %s key from the sequence window" % key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 def _worker_running(func):
     """ Ensures the message worker thread is still running and hasn't failed for any reason. """
     def wrapped(self, *args, **kwargs):
@@ -653,11 +716,10 @@ class Connection(object):
         # it MAY contain a response from the server as well
         self.outstanding_requests = dict()
 
-        # Table of available sequence numbers
-        self.sequence_window = dict(
-            low=0,
-            high=1
-        )
+        # Range of available sequence numbers, low is the next message id to use and high is the first id that has
+        # not been granted by the server
+        self.sequence_window_low = 0
+        self.sequence_window_high = 1
         self.sequence_lock = Lock()
 
         # Byte array containing the negotiate token and remembered for
@@ -700,8 +762,8 @@ class Connection(object):
         self.preauth_integrity_hash_id = None
 
         # Preauth integrity hash value computed for the SMB2 NEGOTIATE request
-        # contains the messages used to compute the hash
-        self.preauth_integrity_hash_value = []
+        # and response
+        self.preauth_integrity_hash_value = b"\x00" * 64
 
         # The cipher object that was negotiated
         self.cipher_id = None
@@ -709,6 +771,16 @@ class Connection(object):
         # Keep track of the message processing thread's potential traceback that it may raise.
         self._t_exc = None
 
+    @property
+    def sequence_window(self):
+        """
+        Deprecated, use sequence_window_low and sequence_window_high instead. Returns a dict like object with the low
+        and high keys that reads and writes through to those attributes.
+        """
+        warnings.warn("Connection.sequence_window is deprecated and will be removed in the next major release, use "
+                      "sequence_window_low and sequence_window_high instead.", DeprecationWarning)
+        return _SequenceWindow(self)
+
     def connect(self, dialect=None, timeout=60):
         """
         Will connect to the target server and negotiate the capabilities
@@ -724,9 +796,10 @@ class Connection(object):
             negotiation process to complete
         """
         log.info("Setting up transport connection")
-        message_queue = Queue()
+        message_queue = deque()
         self.transport = Tcp(self.server_name, self.port, message_queue, timeout)
-        t_worker = threading.Thread(target=self._process_message_thread, args=(message_queue,),
+        t_worker = threading.Thread(target=self._process_message_thread,
+                                    args=(message_queue, self.transport.recv_event),
                                     name="msg_worker-%s:%s" % (self.server_name, self.port))
         t_worker.daemon = True
         t_worker.start()
@@ -742,50 +815,45 @@ class Connection(object):
         self.server_guid = smb_response['server_guid'].get_value()
         self.gss_negotiate_token = smb_response['buffer'].get_value()
 
+        capabilities = smb_response['capabilities']
+        self.server_capabilities = capabilities
+        self.server_security_mode = smb_response['security_mode'].get_value()
+
         if not self.require_signing and \
-                smb_response['security_mode'].has_flag(
-                    SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED):
+                self.server_security_mode & SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED:
             self.require_signing = True
         log.info("Connection require signing: %s" % self.require_signing)
 
-        capabilities = smb_response['capabilities']
-        self.server_capabilities = capabilities
-        self.server_security_mode = smb_response['security_mode'].get_value()
+        # Test the capability bits on the raw int rather than calling has_flag() for each one.
+        caps = capabilities.get_value()
 
         # SMB 2.1
         if self.dialect >= Dialects.SMB_2_1_0:
-            self.supports_file_leasing = \
-                capabilities.has_flag(Capabilities.SMB2_GLOBAL_CAP_LEASING)
-            self.supports_multi_credit = \
-                capabilities.has_flag(Capabilities.SMB2_GLOBAL_CAP_LARGE_MTU)
+            self.supports_file_leasing = bool(caps & Capabilities.SMB2_GLOBAL_CAP_LEASING)
+            self.supports_multi_credit = bool(caps & Capabilities.SMB2_GLOBAL_CAP_LARGE_MTU)
 
         # SMB 3.x
         if self.dialect >= Dialects.SMB_3_0_0:
-            self.supports_directory_leasing = capabilities.has_flag(
-                Capabilities.SMB2_GLOBAL_CAP_DIRECTORY_LEASING)
-            self.supports_multi_channel = capabilities.has_flag(
-                Capabilities.SMB2_GLOBAL_CAP_MULTI_CHANNEL)
+            self.supports_directory_leasing = bool(caps & Capabilities.SMB2_GLOBAL_CAP_DIRECTORY_LEASING)
+            self.supports_multi_channel = bool(caps & Capabilities.SMB2_GLOBAL_CAP_MULTI_CHANNEL)
 
             # TODO: SMB2_GLOBAL_CAP_PERSISTENT_HANDLES
             self.supports_persistent_handles = False
-            self.supports_encryption = capabilities.has_flag(
-                Capabilities.SMB2_GLOBAL_CAP_ENCRYPTION) \
+            self.supports_encryption = bool(caps & Capabilities.SMB2_GLOBAL_CAP_ENCRYPTION) \
                 and self.dialect < Dialects.SMB_3_1_1
 
             # TODO: Check/add server to server_list in Client Page 203
 
         # SMB 3.1
         if self.dialect >= Dialects.SMB_3_1_1:
+            context_handlers = {
+                NegotiateContextType.SMB2_ENCRYPTION_CAPABILITIES: self._process_encryption_context,
+                NegotiateContextType.SMB2_PREAUTH_INTEGRITY_CAPABILITIES: self._process_preauth_integrity_context,
+            }
             for context in smb_response['negotiate_context_list']:
-                if context['context_type'].get_value() == \
-                        NegotiateContextType.SMB2_ENCRYPTION_CAPABILITIES:
-                    cipher_id = context['data']['ciphers'][0]
-                    self.cipher_id = Ciphers.get_cipher(cipher_id)
-                    self.supports_encryption = self.cipher_id != 0
-                else:
-                    hash_id = context['data']['hash_algorithms'][0]
-                    self.preauth_integrity_hash_id = \
-                        HashAlgorithms.get_algorithm(hash_id)
+                handler = context_handlers.get(context['context_type'].get_value(), None)
+                if handler:
+                    handler(context)
 
     def disconnect(self, close=True):
         """
@@ -836,6 +904,40 @@ class Connection(object):
         """
         return self._send(messages, session_id=sid, tree_id=tid, related=related)
 
+    @_worker_running
+    def send_many(self, messages, sid=None, tid=None):
+        """
+        Sends multiple messages as separate SMB requests in a single write to the transport. Unlike send_compound()
+        each message is signed or encrypted as its own request, this is useful for pipelining a sequence of bulk
+        read or write requests where each request is limited by the max read/write size and not by the compound
+        rules of a single request.
+
+        :param messages: A list of messages to send to the server.
+        :param sid: The session_id that the requests are sent for.
+        :param tid: A tree_id object that the requests are sent for.
+        :return: List<Request> for each request that was sent, each entry in the list is in the same order of the
+            message list that was passed in.
+        """
+        if any(message.COMMAND == Commands.SMB2_CANCEL for message in messages):
+            raise ValueError("Cannot send an SMB2 CANCEL request with send_many(), use Request.cancel() instead")
+
+        # Look up the tree and allocate the message ids for the whole batch before any request is built so a failure
+        # doesn't leave the earlier requests outstanding with their credits consumed. The messages are then signed or
+        # encrypted outside of the sequence lock.
+        self._get_session_tree(sid, tid)
+        allocated_ids = self._allocate_message_ids(messages)
+
+        send_data = []
+        requests = []
+        for message, allocated_id in zip(messages, allocated_ids):
+            b_data, message_requests = self._build_send_data([message], session_id=sid, tree_id=tid,
+                                                             allocated_ids=[allocated_id])
+            send_data.append(b_data)
+            requests.extend(message_requests)
+
+        self.transport.send_many(send_data)
+        return requests
+
     @_worker_running
     def receive(self, request, wait=True, timeout=None, resolve_symlinks=True):
         """
@@ -980,24 +1082,28 @@ class Connection(object):
         :param force: Force verification of the header even if it does not match the criteria required in normal
             scenarios.
         """
-        message_id = header['message_id'].get_value()
-        flags = header['flags']
-        status = header['status'].get_value()
-        command = header['command'].get_value()
-
-        if not force and (message_id == 0xFFFFFFFFFFFFFFFF or
-                          not flags.has_flag(Smb2Flags.SMB2_FLAGS_SIGNED) or
-                          status == NtStatus.STATUS_PENDING or
-                          command == Commands.SMB2_SESSION_SETUP):
+        if not force and not self._requires_verification(header['message_id'].get_value(),
+                                                         header['flags'].get_value(),
+                                                         header['status'].get_value(),
+                                                         header['command'].get_value()):
             return
 
+        self._verify_signature(header, session_id)
+
+    def _requires_verification(self, message_id, flags, status, command):
+        return not (message_id == 0xFFFFFFFFFFFFFFFF or
+                    not flags & Smb2Flags.SMB2_FLAGS_SIGNED or
+                    status == NtStatus.STATUS_PENDING or
+                    command == Commands.SMB2_SESSION_SETUP)
+
+    def _verify_signature(self, header, session_id):
         session = self.session_table.get(session_id, None)
         if session is None:
             raise SMBException("Failed to find session %s for message verification" % session_id)
 
-        expected = self._generate_signature(header.pack(), session.signing_key)
+        expected = self._generate_signature(header.pack(), session)
         actual = header['signature'].get_value()
-        if actual != expected:
+        if not hmac.compare_digest(actual, expected):
             raise SMBException("Server message signature could not be verified: %s != %s"
                                % (to_native(binascii.hexlify(actual)), to_native(binascii.hexlify(expected))))
 
@@ -1010,14 +1116,29 @@ class Connection(object):
     @_worker_running
     def _send(self, messages, session_id=None, tree_id=None, message_id=None, credit_request=None, related=False,
               async_id=None, force_signature=False):
+        send_data, requests = self._build_send_data(messages, session_id=session_id, tree_id=tree_id,
+                                                    message_id=message_id, credit_request=credit_request,
+                                                    related=related, async_id=async_id,
+                                                    force_signature=force_signature)
+        self.transport.send(send_data)
+        return requests
+
+    def _build_send_data(self, messages, session_id=None, tree_id=None, message_id=None, credit_request=None,
+                         related=False, async_id=None, force_signature=False, allocated_ids=None):
+        """
+        Builds the (compound) SMB request for the messages and registers each Request in outstanding_requests. The
+        data is signed or encrypted as required by the session and tree.
+
+        :param allocated_ids: The (message_id, credit_charge) for each message from _allocate_message_ids(), if not
+            set the ids are allocated here.
+        :return: A tuple of the bytes to send to the transport and the List<Request> for each message.
+        """
         send_data = b""
         requests = []
-        session = self.session_table.get(session_id, None)
-        tree = None
-        if tree_id and session:
-            if tree_id not in session.tree_connect_table:
-                raise SMBException("Cannot find Tree with the ID %d in the session tree table" % tree_id)
-            tree = session.tree_connect_table[tree_id]
+        session, tree = self._get_session_tree(session_id, tree_id)
+
+        if allocated_ids is None:
+            allocated_ids = self._allocate_message_ids(messages, message_id=message_id)
 
         total_requests = len(messages)
         for i, message in enumerate(messages):
@@ -1032,21 +1153,7 @@ class Connection(object):
                 next_command = msg_length + padding_length
                 padding = b"\x00" * padding_length
 
-            # When running with multiple threads we need to ensure that getting the message id and adjusting the
-            # sequence windows is done in a thread safe manner so we use a lock to ensure only 1 thread accesses the
-            # sequence window at a time.
-            with self.sequence_lock:
-                sequence_window_low = self.sequence_window['low']
-                sequence_window_high = self.sequence_window['high']
-                credit_charge = self._calculate_credit_charge(message)
-                credits_available = sequence_window_high - sequence_window_low
-                if credit_charge > credits_available:
-                    raise SMBException("Request requires %d credits but only %d credits are available"
-                                       % (credit_charge, credits_available))
-
-                current_id = message_id or sequence_window_low
-                if message.COMMAND != Commands.SMB2_CANCEL:
-                    self.sequence_window['low'] += credit_charge if credit_charge > 0 else 1
+            current_id, credit_charge = allocated_ids[i]
 
             if async_id is None:
                 header = SMB2HeaderRequest()
@@ -1072,7 +1179,7 @@ class Connection(object):
             if force_signature or (session and session.signing_required and session.signing_key):
                 header['flags'].set_flag(Smb2Flags.SMB2_FLAGS_SIGNED)
                 b_header = header.pack() + padding
-                signature = self._generate_signature(b_header, session.signing_key)
+                signature = self._generate_signature(b_header, session)
 
                 # To save on unpacking and re-packing, manually adjust the signature and update the request object for
                 # back-referencing.
@@ -1084,17 +1191,21 @@ class Connection(object):
             send_data += b_header
 
             if message.COMMAND == Commands.SMB2_CANCEL:
-                request = self.outstanding_requests[header['message_id'].get_value()]
+                request = self.outstanding_requests[current_id]
             else:
                 request = Request(header, type(message), self, session_id=session_id)
-                self.outstanding_requests[header['message_id'].get_value()] = request
+                self.outstanding_requests[current_id] = request
 
-            # Make sure the preauth integrity values are updated for a negotiate or session setup message.
+            # Make sure the preauth integrity values are updated for a negotiate or session setup message. The
+            # dialect is not known until the negotiate is done but the session value is only used by SMB 3.1.1.
             if message.COMMAND == Commands.SMB2_NEGOTIATE:
-                self.preauth_integrity_hash_value.append(b_header)
+                self.preauth_integrity_hash_value = self._update_preauth_integrity_hash(
+                    self.preauth_integrity_hash_value, b_header)
 
-            elif message.COMMAND == Commands.SMB2_SESSION_SETUP:
-                self.preauth_session_table[session_id].preauth_integrity_hash_value.append(b_header)
+            elif message.COMMAND == Commands.SMB2_SESSION_SETUP and self.dialect >= Dialects.SMB_3_1_1:
+                preauth_session = self.preauth_session_table[session_id]
+                preauth_session.preauth_integrity_hash_value = self._update_preauth_integrity_hash(
+                    preauth_session.preauth_integrity_hash_value, b_header)
 
             requests.append(request)
 
@@ -1104,18 +1215,64 @@ class Connection(object):
         if session and session.encrypt_data or tree and tree.encrypt_data:
             send_data = self._encrypt(send_data, session)
 
-        self.transport.send(send_data)
-        return requests
+        return send_data, requests
 
-    def _process_message_thread(self, msg_queue):
+    def _get_session_tree(self, session_id, tree_id):
+        """
+        Gets the Session and TreeConnect the message is sent for, either may be None if it is not set.
+
+        :param session_id: The session_id the message is sent for.
+        :param tree_id: The tree_id the message is sent for.
+        :return: A tuple of the Session and TreeConnect.
+        """
+        session = self.session_table.get(session_id, None)
+        tree = None
+        if tree_id and session:
+            if tree_id not in session.tree_connect_table:
+                raise SMBException("Cannot find Tree with the ID %d in the session tree table" % tree_id)
+            tree = session.tree_connect_table[tree_id]
+
+        return session, tree
+
+    def _allocate_message_ids(self, messages, message_id=None):
+        """
+        Gets the message id and credit charge for each message and moves the sequence window past them. The credits of
+        every message are checked before the window is moved so nothing is allocated if one of them cannot be sent.
+
+        :param messages: A list of messages to allocate the message ids for.
+        :param message_id: Use this message_id instead of the next one in the sequence window, only useful for a
+            cancel request.
+        :return: A list of (message_id, credit_charge) tuples for each message.
+        """
+        allocated_ids = []
+
+        # When running with multiple threads we need to ensure that getting the message id and adjusting the
+        # sequence windows is done in a thread safe manner so we use a lock to ensure only 1 thread accesses the
+        # sequence window at a time.
+        with self.sequence_lock:
+            sequence_window_low = self.sequence_window_low
+            for message in messages:
+                credit_charge = self._calculate_credit_charge(message)
+                credits_available = self.sequence_window_high - sequence_window_low
+                if credit_charge > credits_available:
+                    raise SMBException("Request requires %d credits but only %d credits are available"
+                                       % (credit_charge, credits_available))
+
+                allocated_ids.append((message_id or sequence_window_low, credit_charge))
+                if message.COMMAND != Commands.SMB2_CANCEL:
+                    sequence_window_low += credit_charge if credit_charge > 0 else 1
+
+            self.sequence_window_low = sequence_window_low
+
+        return allocated_ids
+
+    def _process_message_thread(self, msg_queue, msg_event):
         while True:
             # Wait for a max of 10 minutes before sending an echo that tells the SMB server the client is still
             # available. This stops the server from closing the connection and the associated sessions on a long lived
             # connection. A brief test shows Windows kills a connection at ~16 minutes so 10 minutes is a safe choice.
             # https://github.com/jborean93/smbprotocol/issues/31
-            try:
-                b_msg = msg_queue.get(timeout=600)
-            except Empty:
+            if not msg_event.wait(timeout=600):
                 log.debug("Sending SMB2 Echo to keep connection alive")
                 for sid in self.session_table.keys():
                     req = self.send(SMB2Echo(), sid=sid)
@@ -1125,127 +1282,175 @@ class Connection(object):
 
                 continue
 
-            # The socket will put None in the queue if it is closed, signalling the end of the connection.
-            if b_msg is None:
-                return
-
-            try:
-                is_encrypted = b_msg[:4] == b"\xfdSMB"
-                if is_encrypted:
-                    msg = SMB2TransformHeader()
-                    msg.unpack(b_msg)
-                    b_msg = self._decrypt(msg)
-
-                next_command = -1
-                while next_command != 0:
-                    next_command = struct.unpack("<L", b_msg[20:24])[0]
-                    header_length = next_command if next_command != 0 else len(b_msg)
-                    b_header = b_msg[:header_length]
-                    b_msg = b_msg[header_length:]
-
-                    header = SMB2HeaderResponse()
-                    header.unpack(b_header)
-
-                    message_id = header['message_id'].get_value()
-                    request = self.outstanding_requests[message_id]
-
-                    # Typically you want to get the Session Id from the first message in a compound request but that is
-                    # unreliable for async responses. Instead get the Session Id from the original request object if
-                    # the Session Id is 0xFFFFFFFFFFFFFFFF.
-                    # https://social.msdn.microsoft.com/Forums/en-US/a580f7bc-6746-4876-83db-6ac209b202c4/mssmb2-change-notify-response-sessionid?forum=os_fileservices
-                    session_id = header['session_id'].get_value()
-                    if session_id == 0xFFFFFFFFFFFFFFFF:
-                        session_id = request.session_id
-
-                    # No need to waste CPU cycles to verify the signature if we already decrypted the header.
-                    if not is_encrypted:
-                        self.verify_signature(header, session_id)
-
-                    credit_response = header['credit_response'].get_value()
-                    if credit_response == 0 and not self.supports_multi_credit:
-                        # If the dialect does not support credits we still need to adjust our sequence window.
-                        # Otherwise the credit response may be 0 in the case of compound responses and the last
-                        # response contains the credits that were granted.
-                        credit_response += 1
-
-                    with self.sequence_lock:
-                        self.sequence_window['high'] += credit_response
-
-                    command = header['command'].get_value()
-                    status = header['status'].get_value()
-                    if command == Commands.SMB2_NEGOTIATE:
-                        self.preauth_integrity_hash_value.append(b_header)
-
-                    elif command == Commands.SMB2_SESSION_SETUP and status == NtStatus.STATUS_MORE_PROCESSING_REQUIRED:
-                        self.preauth_session_table[message_id] = b_header
-
-                    with request.response_event_lock:
-                        if header['flags'].has_flag(Smb2Flags.SMB2_FLAGS_ASYNC_COMMAND):
-                            request.async_id = b_header[32:40]
-
-                        request.response = header
+            # Clear the event before draining so a message the socket appends after the deque is emptied sets it again.
+            # popleft() on a deque is atomic so every message queued up is taken without acquiring a lock for each one.
+            msg_event.clear()
+            while True:
+                try:
+                    b_msg = msg_queue.popleft()
+                except IndexError:
+                    break
+
+                # The socket will put None in the queue if it is closed, signalling the end of the connection.
+                if b_msg is None:
+                    return
+
+                try:
+                    self._process_message(b_msg)
+                except Exception as exc:
+                    # The exception is raised in _check_worker_running by the main thread when send/receive is called
+                    # next.
+                    self._t_exc = exc
+
+                    # Make sure we fire all the request events to ensure the main thread isn't waiting on a receive.
+                    for request in self.outstanding_requests.values():
                         request.response_event.set()
 
-                        # When we send a ping in this thread we want to make sure it doesn't linger in the outstanding
-                        # request queue.
-                        if request.message['reserved'].get_value() == 1:
-                            del self.outstanding_requests[message_id]
-            except Exception as exc:
-                # The exception is raised in _check_worker_running by the main thread when send/receive is called next.
-                self._t_exc = exc
+                    # While a caller of send/receive could theoretically catch this exception, we consider any
+                    # failures here a fatal errors and the connection should be closed so we exit the worker thread.
+                    self.disconnect(False)
+                    return
+
+    def _process_message(self, b_msg):
+        is_encrypted = b_msg[:4] == b"\xfdSMB"
+        if is_encrypted:
+            msg = SMB2TransformHeader()
+            msg.unpack(b_msg)
+            b_msg = self._decrypt(msg)
+
+        next_command = -1
+        while next_command != 0:
+            # Read the values needed to route the response straight from the fixed header layout, get_value() on the
+            # unpacked structure re-parses the field on every call.
+            status, command, credit_response, flags, next_command, message_id, b_async_id, session_id = \
+                _SMB2_HEADER_STRUCT.unpack_from(b_msg)[3:11]
+
+            header_length = next_command if next_command != 0 else len(b_msg)
+            b_header = b_msg[:header_length]
+            b_msg = b_msg[header_length:]
+
+            header = SMB2HeaderResponse()
+            header.unpack(b_header)
+
+            request = self.outstanding_requests[message_id]
+
+            # Typically you want to get the Session Id from the first message in a compound request but that is
+            # unreliable for async responses. Instead get the Session Id from the original request object if
+            # the Session Id is 0xFFFFFFFFFFFFFFFF.
+            # https://social.msdn.microsoft.com/Forums/en-US/a580f7bc-6746-4876-83db-6ac209b202c4/mssmb2-change-notify-response-sessionid?forum=os_fileservices
+            if session_id == 0xFFFFFFFFFFFFFFFF:
+                session_id = request.session_id
+
+            # No need to waste CPU cycles to verify the signature if we already decrypted the header.
+            if not is_encrypted and self._requires_verification(message_id, flags, status, command):
+                self._verify_signature(header, session_id)
+
+            if credit_response == 0 and not self.supports_multi_credit:
+                # If the dialect does not support credits we still need to adjust our sequence window.
+                # Otherwise the credit response may be 0 in the case of compound responses and the last
+                # response contains the credits that were granted.
+                credit_response += 1
 
-                # Make sure we fire all the request events to ensure the main thread isn't waiting on a receive.
-                for request in self.outstanding_requests.values():
-                    request.response_event.set()
+            with self.sequence_lock:
+                self.sequence_window_high += credit_response
 
-                # While a caller of send/receive could theoretically catch this exception, we consider any failures
-                # here a fatal errors and the connection should be closed so we exit the worker thread.
-                self.disconnect(False)
-                return
+            if command == Commands.SMB2_NEGOTIATE:
+                self.preauth_integrity_hash_value = self._update_preauth_integrity_hash(
+                    self.preauth_integrity_hash_value, b_header)
 
-    def _generate_signature(self, b_header, signing_key):
-        b_header = b_header[:48] + (b"\x00" * 16) + b_header[64:]
+            elif command == Commands.SMB2_SESSION_SETUP and status == NtStatus.STATUS_MORE_PROCESSING_REQUIRED and \
+                    self.dialect >= Dialects.SMB_3_1_1:
+                # The final session setup response is not part of the preauth integrity hash, only the ones that
+                # require more processing. The session is still under the id the request was sent with.
+                preauth_session = self.preauth_session_table[request.session_id]
+                preauth_session.preauth_integrity_hash_value = self._update_preauth_integrity_hash(
+                    preauth_session.preauth_integrity_hash_value, b_header)
+
+            with request.response_event_lock:
+                if flags & Smb2Flags.SMB2_FLAGS_ASYNC_COMMAND:
+                    request.async_id = b_async_id
+
+                request.response = header
+                request.response_event.set()
+
+                # When we send a ping in this thread we want to make sure it doesn't linger in the outstanding
+                # request queue.
+                if request.message['reserved'].get_value() == 1:
+                    del self.outstanding_requests[message_id]
+
+    def _generate_signature(self, b_header, session):
+        # Blank out the signature slot in place on a single copy of the data rather than slicing and concatenating
+        # which creates multiple intermediate copies of the full message. Older cryptography versions only accept bytes
+        # in CMAC.update() so convert it back before it is used.
+        b_header = bytearray(b_header)
+        b_header[48:64] = b"\x00" * 16
+        b_header = bytes(b_header)
+
+        # The keyed CMAC/HMAC context is created once per signing key and cloned for each message, this saves on
+        # running the AES key schedule or HMAC key padding for every message that is signed or verified.
+        signing_context = session.signing_context
+        if signing_context is None:
+            if self.dialect >= Dialects.SMB_3_0_0:
+                signing_context = cmac.CMAC(algorithms.AES(session.signing_key), backend=default_backend())
+            else:
+                signing_context = _hmac_sha256_contexts(session.signing_key)
+            session.signing_context = signing_context
 
         if self.dialect >= Dialects.SMB_3_0_0:
-            c = cmac.CMAC(algorithms.AES(signing_key), backend=default_backend())
+            c = signing_context.copy()
             c.update(b_header)
             signature = c.finalize()
         else:
-            hmac_algo = hmac.new(signing_key, msg=b_header, digestmod=hashlib.sha256)
-            signature = hmac_algo.digest()[:16]
+            # HMAC(K, m) = H((K ^ opad) || H((K ^ ipad) || m))
+            inner, outer = signing_context
+            inner = inner.copy()
+            inner.update(b_header)
+            outer = outer.copy()
+            outer.update(inner.digest())
+            signature = outer.digest()[:16]
 
         return signature
 
     def _encrypt(self, b_data, session):
-        header = SMB2TransformHeader()
-        header['original_message_size'] = len(b_data)
-        header['session_id'] = session.session_id
+        """
+        Encrypts the data and returns the packed SMB2 TRANSFORM_HEADER message that is sent to the server. The header
+        is assembled directly as bytes rather than through SMB2TransformHeader to avoid packing the encrypted data
+        through the structure and again in the transport.
 
-        encryption_key = session.encryption_key
+        :param b_data: The packed SMB2 message(s) to encrypt.
+        :param session: The Session whose encryption key is used.
+        :return: The packed SMB2 TRANSFORM_HEADER bytes.
+        """
         if self.dialect >= Dialects.SMB_3_1_1:
             cipher = self.cipher_id
         else:
             cipher = Ciphers.get_cipher(Ciphers.AES_128_CCM)
-        if cipher == aead.AESGCM:
-            nonce = os.urandom(12)
-            header['nonce'] = nonce + (b"\x00" * 4)
-        else:
-            nonce = os.urandom(11)
-            header['nonce'] = nonce + (b"\x00" * 5)
+        # The nonce only needs to be unique for each message encrypted with the session key. A random per session
+        # prefix followed by a message counter guarantees that without reading from os.urandom() for every message.
+        # next() on the counter is atomic so concurrent senders never get the same value.
+        nonce_length = 12 if cipher == aead.AESGCM else 11
+        nonce = session.nonce_prefix[:nonce_length - 8] + struct.pack("<Q", next(session.nonce_counter))
+        b_nonce = nonce + (b"\x00" * (16 - nonce_length))
 
-        cipher_text = cipher(encryption_key).encrypt(nonce, b_data, header.pack()[20:])
-        signature = cipher_text[-16:]
-        enc_message = cipher_text[:-16]
+        # The AAD is the transform header from the nonce to the session id, it is packed once here and used as is in
+        # the final message.
+        aad = _SMB2_TRANSFORM_AAD_STRUCT.pack(b_nonce, len(b_data), 0, 0x0001, session.session_id)
 
-        header['signature'] = signature
-        header['data'] = enc_message
+        # Re-use the AEAD object for the session key rather than creating a new one, and the key setup that comes with
+        # it, for every message.
+        encryption_context = session.encryption_context
+        if encryption_context is None:
+            encryption_context = session.encryption_context = cipher(session.encryption_key)
 
-        return header
+        # The AEAD tag is appended to the cipher text but is the signature that precedes the AAD in the header.
+        cipher_text = encryption_context.encrypt(nonce, b_data, aad)
+        return b"".join([b"\xfdSMB", cipher_text[-16:], aad, cipher_text[:-16]])
 
     def _decrypt(self, message):
-        if message['flags'].get_value() != 0x0001:
+        flags = message['flags'].get_value()
+        if flags != 0x0001:
             error_msg = "Expecting flag of 0x0001 but got %s in the SMB Transform Header Response" \
-                        % format(message['flags'].get_value(), 'x')
+                        % format(flags, 'x')
             raise SMBException(error_msg)
 
         session_id = message['session_id'].get_value()
@@ -1260,15 +1465,33 @@ class Connection(object):
             cipher = Ciphers.get_cipher(Ciphers.AES_128_CCM)
 
         nonce_length = 12 if cipher == aead.AESGCM else 11
-        nonce = message['nonce'].get_value()[:nonce_length]
+        b_nonce = message['nonce'].get_value()
+        nonce = b_nonce[:nonce_length]
+
+        # Pack the AAD from the parsed values instead of re-packing the whole transform header, including the
+        # encrypted data, just to slice out these 32 bytes.
+        aad = _SMB2_TRANSFORM_AAD_STRUCT.pack(b_nonce, message['original_message_size'].get_value(),
+                                              message['reserved'].get_value(), flags, session_id)
 
         signature = message['signature'].get_value()
         enc_message = message['data'].get_value() + signature
 
-        c = cipher(session.decryption_key)
-        dec_message = c.decrypt(nonce, enc_message, message.pack()[20:52])
+        decryption_context = session.decryption_context
+        if decryption_context is None:
+            decryption_context = session.decryption_context = cipher(session.decryption_key)
+
+        dec_message = decryption_context.decrypt(nonce, enc_message, aad)
         return dec_message
 
+    def _process_encryption_context(self, context):
+        cipher_id = context['data']['ciphers'][0]
+        self.cipher_id = Ciphers.get_cipher(cipher_id)
+        self.supports_encryption = self.cipher_id != 0
+
+    def _process_preauth_integrity_context(self, context):
+        hash_id = context['data']['hash_algorithms'][0]
+        self.preauth_integrity_hash_id = HashAlgorithms.get_algorithm(hash_id)
+
     def _send_smb2_negotiate(self, dialect, timeout):
         self.salt = os.urandom(32)
 
@@ -1358,6 +1581,22 @@ class Connection(object):
 
         return smb_response
 
+    def _update_preauth_integrity_hash(self, hash_value, b_msg):
+        """
+        [MS-SMB2] v53.0 2017-09-15
+
+        3.2.5.2 Receiving an SMB2 NEGOTIATE Response
+        Computes the next preauth integrity hash value as H(previous value || message). SHA-512 is the only algorithm
+        the client offers so it is also used for the negotiate messages that are hashed before the server's choice is
+        known.
+
+        :param hash_value: The current preauth integrity hash value.
+        :param b_msg: The SMB2 NEGOTIATE or SESSION_SETUP message bytes to add to the hash.
+        :return: The new preauth integrity hash value.
+        """
+        hash_al = self.preauth_integrity_hash_id or hashlib.sha512
+        return hash_al(hash_value + b_msg).digest()
+
     def _calculate_credit_charge(self, message):
         """
         Calculates the credit charge for a request based on the command. If
@@ -2,7 +2,9 @@
 # Copyright: (c) 2019, Jordan Borean (@jborean93) <jborean93@gmail.com>
 # MIT License (see LICENSE or https://opensource.org/licenses/MIT)
 
+import itertools
 import logging
+import os
 import random
 import spnego
 
@@ -252,10 +254,48 @@ class Session(object):
         self.signing_key = None
         self.application_key = None
 
+        # Keyed CMAC/HMAC and AEAD objects for the keys above, built on first use by the Connection and reset when the
+        # corresponding key changes
+        self.signing_context = None
+        self.encryption_context = None
+        self.decryption_context = None
+
+        # Random prefix and message counter used to build a unique nonce for each encrypted message
+        self.nonce_prefix = os.urandom(4)
+        self.nonce_counter = itertools.count()
+
         # SMB 3.1.1+
         # Preauth integrity value computed for the exhange of SMB2
-        # SESSION_SETUP request and response for this session
-        self.preauth_integrity_hash_value = []
+        # SESSION_SETUP request and response for this session, starts from the
+        # connection's value when the session is set up
+        self.preauth_integrity_hash_value = None
+
+    @property
+    def encryption_key(self):
+        return self._encryption_key
+
+    @encryption_key.setter
+    def encryption_key(self, value):
+        self._encryption_key = value
+        self.encryption_context = None
+
+    @property
+    def decryption_key(self):
+        return self._decryption_key
+
+    @decryption_key.setter
+    def decryption_key(self, value):
+        self._decryption_key = value
+        self.decryption_context = None
+
+    @property
+    def signing_key(self):
+        return self._signing_key
+
+    @signing_key.setter
+    def signing_key(self, value):
+        self._signing_key = value
+        self.signing_context = None
 
     def connect(self):
         log.debug("Decoding SPNEGO token containing supported auth mechanisms")
@@ -266,6 +306,7 @@ class Session(object):
             raise SMBAuthenticationError("Failed to authenticate with server: %s" % str(err.message))
 
         self.connection.preauth_session_table[self.session_id] = self
+        self.preauth_integrity_hash_value = self.connection.preauth_integrity_hash_value
         in_token = self.connection.gss_negotiate_token
         if self.auth_protocol != 'negotiate':
             in_token = None  # The GSS Negotiate Token can only be used for Negotiate auth.
@@ -312,8 +353,6 @@ class Session(object):
             status = response['status'].get_value()
             if status == NtStatus.STATUS_MORE_PROCESSING_REQUIRED:
                 log.info("More processing is required for SMB2_SESSION_SETUP")
-                preauth_value = self.connection.preauth_session_table.pop(response['message_id'].get_value())
-                self.preauth_integrity_hash_value.append(preauth_value)
 
         log.info("Setting session id to %s" % self.session_id)
         self._connected = True
@@ -325,12 +364,7 @@ class Session(object):
         self.session_key = context.session_key[:16].ljust(16, b"\x00")
 
         if self.connection.dialect >= Dialects.SMB_3_1_1:
-            preauth_hash = b"\x00" * 64
-            hash_al = self.connection.preauth_integrity_hash_id
-            for hash_list in [self.connection.preauth_integrity_hash_value, self.preauth_integrity_hash_value]:
-                for message in hash_list:
-                    preauth_hash = hash_al(preauth_hash + message).digest()
-
+            preauth_hash = self.preauth_integrity_hash_value
             self.signing_key = self._smb3kdf(self.session_key, b"SMBSigningKey\x00", preauth_hash)
             self.application_key = self._smb3kdf(self.session_key, b"SMBAppKey\x00", preauth_hash)
             self.encryption_key = self._smb3kdf(self.session_key, b"SMBC2SCipherKey\x00", preauth_hash)
@@ -18,11 +18,6 @@ from smbprotocol.structure import (
     Structure,
 )
 
-try:
-    from queue import Queue
-except ImportError:  # pragma: no cover
-    from Queue import Queue
-
 log = logging.getLogger(__name__)
 
 
@@ -82,6 +77,14 @@ class Tcp(object):
         self._recv_queue = recv_queue
         self._t_recv = None
 
+        # Set whenever a message is appended to the recv_queue deque, the consumer clears it before draining the
+        # deque so a message appended afterwards sets it again.
+        self.recv_event = threading.Event()
+
+        # The message is built and encrypted/signed by the caller outside of any lock, this only serializes the
+        # socket writes so that the data of concurrent senders is not interleaved on the wire.
+        self._send_lock = threading.Lock()
+
     def close(self):
         if self._connected:
             log.info("Disconnecting DirectTcp socket")
@@ -94,19 +97,39 @@ class Tcp(object):
 
     @socket_connect
     def send(self, header):
-        b_msg = header
-        data_length = len(b_msg)
-        if data_length > self.MAX_SIZE:
-            raise ValueError("Data to be sent over Direct TCP size %d exceeds the max length allowed %d"
-                             % (data_length, self.MAX_SIZE))
+        self._send_packets([header])
 
-        tcp_packet = DirectTCPPacket()
-        tcp_packet['smb2_message'] = b_msg
-
-        data = tcp_packet.pack()
-        while data:
-            sent = self._sock.send(data)
-            data = data[sent:]
+    @socket_connect
+    def send_many(self, messages):
+        """
+        Sends multiple SMB messages, each framed in its own Direct TCP packet, with a single write to the socket.
+
+        :param messages: A list of the SMB message bytes to send.
+        """
+        self._send_packets(messages)
+
+    def _send_packets(self, messages):
+        packets = []
+        for b_msg in messages:
+            data_length = len(b_msg)
+            if data_length > self.MAX_SIZE:
+                raise ValueError("Data to be sent over Direct TCP size %d exceeds the max length allowed %d"
+                                 % (data_length, self.MAX_SIZE))
+
+            tcp_packet = DirectTCPPacket()
+            tcp_packet['smb2_message'] = b_msg
+            packets.append(tcp_packet.pack())
+
+        # Use a memoryview so a partial send does not copy the remaining data each time.
+        data = memoryview(b"".join(packets))
+        with self._send_lock:
+            while data:
+                sent = self._sock.send(data)
+                data = data[sent:]
+
+    def _queue_message(self, b_msg):
+        self._recv_queue.append(b_msg)
+        self.recv_event.set()
 
     def recv_thread(self):
         try:
@@ -124,7 +147,7 @@ class Tcp(object):
                     b_data.extend(b_fragment)
                     bytes_read += len(b_fragment)
 
-                self._recv_queue.put(bytes(b_data))
+                self._queue_message(bytes(b_data))
         except Exception as e:
             # Log a warning if the exception was raised while we were connected and not just some weird platform-ism
             # exception when reading from a closed socket.
@@ -133,4 +156,4 @@ class Tcp(object):
             return
         finally:
             # Make sure we close the message processing thread in connection.py
-            self._recv_queue.put(None)
+            self._queue_message(None)
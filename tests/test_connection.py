@@ -3,14 +3,20 @@
 # MIT License (see LICENSE or https://opensource.org/licenses/MIT)
 
 import hashlib
+import hmac
 import os
 import pytest
+import threading
 import uuid
 
 from cryptography.hazmat.primitives.ciphers import (
     aead,
 )
 
+from collections import (
+    deque,
+)
+
 from datetime import (
     datetime,
 )
@@ -20,6 +26,7 @@ from smbprotocol import (
 )
 
 from smbprotocol.connection import (
+    _hmac_sha256_contexts,
     Ciphers,
     Connection,
     HashAlgorithms,
@@ -38,7 +45,10 @@ from smbprotocol.connection import (
 )
 
 from smbprotocol.header import (
+    Commands,
+    NtStatus,
     Smb2Flags,
+    SMB2HeaderRequest,
     SMB2HeaderResponse,
 )
 
@@ -52,9 +62,29 @@ from smbprotocol.exceptions import (
 
 from smbprotocol.session import (
     Session,
+    SMB2SessionSetupRequest,
 )
 
 
+class RecordingTransport(object):
+    """ Records the messages passed to send_many() instead of sending them. """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_many(self, messages):
+        self.sent.append(messages)
+
+
+@pytest.mark.parametrize('key', [b"\x01" * 16, b"\x02" * 65])
+def test_hmac_sha256_contexts(key):
+    inner, outer = _hmac_sha256_contexts(key)
+    inner.update(b"\x03\x04")
+    outer.update(inner.digest())
+
+    assert outer.digest() == hmac.new(key, msg=b"\x03\x04", digestmod=hashlib.sha256).digest()
+
+
 def test_valid_hash_algorithm():
     expected = hashlib.sha512
     actual = HashAlgorithms.get_algorithm(0x1)
@@ -737,10 +767,10 @@ class TestConnection(object):
             assert connection.dialect == Dialects.SMB_2_0_2
             assert connection.negotiated_dialects == [Dialects.SMB_2_0_2]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED
 
@@ -760,10 +790,10 @@ class TestConnection(object):
             assert connection.dialect == Dialects.SMB_2_1_0
             assert connection.negotiated_dialects == [Dialects.SMB_2_1_0]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED
 
@@ -783,10 +813,10 @@ class TestConnection(object):
             assert connection.dialect == Dialects.SMB_3_0_0
             assert connection.negotiated_dialects == [Dialects.SMB_3_0_0]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED
 
@@ -806,10 +836,10 @@ class TestConnection(object):
             assert connection.dialect == Dialects.SMB_3_0_2
             assert connection.negotiated_dialects == [Dialects.SMB_3_0_2]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED
 
@@ -829,10 +859,10 @@ class TestConnection(object):
             assert connection.dialect == Dialects.SMB_3_1_1
             assert connection.negotiated_dialects == [Dialects.SMB_3_1_1]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_ENABLED
 
@@ -860,10 +890,10 @@ class TestConnection(object):
                 Dialects.SMB_3_1_1
             ]
             assert connection.gss_negotiate_token is not None
-            assert len(connection.preauth_integrity_hash_value) == 2
+            assert len(connection.preauth_integrity_hash_value) == 64
             assert len(connection.salt) == 32
-            assert connection.sequence_window['low'] == 1
-            assert connection.sequence_window['high'] == 2
+            assert connection.sequence_window_low == 1
+            assert connection.sequence_window_high == 2
             assert connection.client_security_mode == \
                 SecurityMode.SMB2_NEGOTIATE_SIGNING_REQUIRED
 
@@ -895,7 +925,7 @@ class TestConnection(object):
             connection.outstanding_requests[666] = test_req
 
             # Put a bad message in the incoming queue to break the worker in a bad way
-            connection.transport._recv_queue.put(b"\x01\x02\x03\x04")
+            connection.transport._queue_message(b"\x01\x02\x03\x04")
             while connection._t_exc is None:
                 pass
 
@@ -927,9 +957,8 @@ class TestConnection(object):
         connection.connect()
         try:
             session.connect()
-            b_header = connection.preauth_integrity_hash_value[-2]
-            header = SMB2HeaderResponse()
-            header.unpack(b_header)
+            # just get some random message
+            header = connection.receive(connection.send(SMB2Echo(), sid=session.session_id))
             # just set some random values for verification failure
             header['flags'].set_flag(Smb2Flags.SMB2_FLAGS_SIGNED)
             header['signature'] = b"\xff" * 16
@@ -946,11 +975,9 @@ class TestConnection(object):
         try:
             session.connect()
             # just get some random message
-            b_header = connection.preauth_integrity_hash_value[-1]
-            header = SMB2HeaderResponse()
-            header.unpack(b_header)
-            enc_header = connection._encrypt(header.pack(), session)
-            assert isinstance(enc_header, SMB2TransformHeader)
+            header = connection.receive(connection.send(SMB2Echo(), sid=session.session_id))
+            enc_header = SMB2TransformHeader()
+            enc_header.unpack(connection._encrypt(header.pack(), session))
             enc_header['flags'] = 5
             with pytest.raises(SMBException) as exc:
                 connection._decrypt(enc_header)
@@ -966,11 +993,9 @@ class TestConnection(object):
         try:
             session.connect()
             # just get some random message
-            b_header = connection.preauth_integrity_hash_value[-1]
-            header = SMB2HeaderResponse()
-            header.unpack(b_header)
-            enc_header = connection._encrypt(header.pack(), session)
-            assert isinstance(enc_header, SMB2TransformHeader)
+            header = connection.receive(connection.send(SMB2Echo(), sid=session.session_id))
+            enc_header = SMB2TransformHeader()
+            enc_header.unpack(connection._encrypt(header.pack(), session))
             enc_header['session_id'] = 100
             with pytest.raises(SMBException) as exc:
                 connection._decrypt(enc_header)
@@ -1031,17 +1056,16 @@ class TestConnection(object):
         session.encryption_key = b"\xff" * 16
 
         expected = SMB2TransformHeader()
-        expected['signature'] = b"\xc8\x73\x0c\x9b\xa7\xe5\x9f\x1c" \
-            b"\xfd\x37\x51\xa1\x95\xf2\xb3\xac"
-        expected['nonce'] = b"\xff" * 11 + b"\x00" * 5
+        expected['signature'] = b"\x7f\x57\x61\xbf\xf7\xd5\x16\xc7" \
+            b"\xed\x12\x89\x6a\x46\x2f\x0c\xaa"
+        expected['nonce'] = b"\xff" * 3 + b"\x00" * 13
         expected['original_message_size'] = 4
         expected['flags'] = 1
         expected['session_id'] = 1
-        expected['data'] = b"\x21\x91\xe3\x0e"
+        expected['data'] = b"\x34\xc9\x91\x09"
 
         actual = connection._encrypt(b"\x01\x02\x03\x04", session)
-        assert isinstance(actual, SMB2TransformHeader)
-        assert actual.pack() == expected.pack()
+        assert actual == expected.pack()
 
     def test_encrypt_gcm(self, monkeypatch):
         def mockurandom(length):
@@ -1056,14 +1080,252 @@ class TestConnection(object):
         session.encryption_key = b"\xff" * 16
 
         expected = SMB2TransformHeader()
-        expected['signature'] = b"\x39\xd8\x32\x34\xd7\x53\xd0\x8e" \
-            b"\xc0\xfc\xbe\x33\x01\x5f\x19\xbd"
-        expected['nonce'] = b"\xff" * 12 + b"\x00" * 4
+        expected['signature'] = b"\x93\x95\x54\x4f\x50\x19\xbf\xe0" \
+            b"\x53\x06\x44\xc2\xf8\x5f\x19\xb9"
+        expected['nonce'] = b"\xff" * 4 + b"\x00" * 12
         expected['original_message_size'] = 4
         expected['flags'] = 1
         expected['session_id'] = 1
-        expected['data'] = b"\xda\x26\x57\x33"
+        expected['data'] = b"\x18\x4b\x1b\xf3"
+
+        actual = connection._encrypt(b"\x01\x02\x03\x04", session)
+        assert actual == expected.pack()
+
+        # The AEAD object is cached on the session and re-used for the next message
+        encryption_context = session.encryption_context
+        assert isinstance(encryption_context, aead.AESGCM)
 
         actual = connection._encrypt(b"\x01\x02\x03\x04", session)
-        assert isinstance(actual, SMB2TransformHeader)
-        assert actual.pack() == expected.pack()
+        assert actual[20:36] == b"\xff" * 4 + b"\x01" + b"\x00" * 11
+        assert session.encryption_context is encryption_context
+
+    def test_generate_signature_hmac(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.dialect = Dialects.SMB_2_1_0
+        session = Session(connection, "user", "pass")
+        session.signing_key = b"\xff" * 16
+
+        b_header = b"\xfeSMB" + b"\x01" * 44 + b"\x03" * 16 + b"\x02" * 8
+        expected = b"\x65\xd5\xd5\x08\x02\x83\x78\x84" \
+            b"\xcb\x53\x78\x3f\x22\xcb\xc0\x7d"
+
+        actual = connection._generate_signature(b_header, session)
+        assert actual == expected
+
+        # Verify the cached signing context is not affected by the previous message
+        actual = connection._generate_signature(b_header, session)
+        assert actual == expected
+
+    def test_generate_signature_cmac(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.dialect = Dialects.SMB_3_0_0
+        session = Session(connection, "user", "pass")
+        session.signing_key = b"\xff" * 16
+
+        b_header = b"\xfeSMB" + b"\x01" * 44 + b"\x03" * 16 + b"\x02" * 8
+        expected = b"\xe2\xfa\x1a\x6f\x4e\xb5\x75\x2b" \
+            b"\x2f\x1c\x62\x19\xe3\x23\xaf\xaf"
+
+        actual = connection._generate_signature(b_header, session)
+        assert actual == expected
+
+        # Verify the cached signing context is not affected by the previous message
+        actual = connection._generate_signature(b_header, session)
+        assert actual == expected
+
+    def test_update_preauth_integrity_hash(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        assert connection.preauth_integrity_hash_value == b"\x00" * 64
+
+        expected = hashlib.sha512(b"\x00" * 64 + b"\x01\x02").digest()
+        expected = hashlib.sha512(expected + b"\x03\x04").digest()
+
+        actual = connection._update_preauth_integrity_hash(connection.preauth_integrity_hash_value, b"\x01\x02")
+        actual = connection._update_preauth_integrity_hash(actual, b"\x03\x04")
+        assert actual == expected
+
+    @pytest.mark.parametrize('dialect', [Dialects.SMB_3_0_2, Dialects.SMB_3_1_1])
+    def test_session_setup_preauth_integrity_hash(self, dialect):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.dialect = dialect
+        connection.preauth_integrity_hash_value = b"\x01" * 64
+        session = Session(connection, "user", "pass")
+        session.preauth_integrity_hash_value = connection.preauth_integrity_hash_value
+        connection.preauth_session_table[session.session_id] = session
+
+        b_request, requests = connection._build_send_data([SMB2SessionSetupRequest()], session_id=session.session_id)
+
+        response = SMB2HeaderResponse()
+        response['status'] = NtStatus.STATUS_MORE_PROCESSING_REQUIRED
+        response['command'] = Commands.SMB2_SESSION_SETUP
+        response['credit_response'] = 1
+        response['flags'].set_flag(Smb2Flags.SMB2_FLAGS_SERVER_TO_REDIR)
+        response['message_id'] = requests[0].message['message_id'].get_value()
+        response['session_id'] = 10
+        b_response = response.pack()
+        connection._process_message(b_response)
+
+        assert requests[0].response_event.is_set()
+        assert connection.preauth_integrity_hash_value == b"\x01" * 64
+
+        if dialect >= Dialects.SMB_3_1_1:
+            expected = hashlib.sha512(b"\x01" * 64 + b_request).digest()
+            expected = hashlib.sha512(expected + b_response).digest()
+        else:
+            # Only SMB 3.1.1 derives the keys from the preauth integrity hash.
+            expected = b"\x01" * 64
+        assert session.preauth_integrity_hash_value == expected
+
+    def test_sequence_window_deprecated(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.sequence_window_low = 2
+        connection.sequence_window_high = 5
+
+        with pytest.warns(DeprecationWarning, match="Connection.sequence_window is deprecated"):
+            actual = connection.sequence_window
+        assert actual == {'low': 2, 'high': 5}
+
+        # Writes to the old dict keys update the new attributes.
+        actual['low'] += 1
+        actual['high'] = 10
+        assert connection.sequence_window_low == 3
+        assert connection.sequence_window_high == 10
+        assert actual == {'low': 3, 'high': 10}
+
+        with pytest.raises(KeyError):
+            actual['other'] = 1
+
+        with pytest.raises(TypeError):
+            del actual['low']
+
+        with pytest.raises(AttributeError):
+            connection.sequence_window = {'low': 0, 'high': 1}
+
+    def test_process_message(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        header = SMB2HeaderRequest()
+        header['command'] = Commands.SMB2_ECHO
+        header['message_id'] = 5
+        header['session_id'] = 1
+        header['data'] = SMB2Echo().pack()
+        request = Request(header, SMB2Echo, connection, session_id=1)
+        connection.outstanding_requests[5] = request
+
+        response = SMB2HeaderResponse()
+        response['status'] = NtStatus.STATUS_PENDING
+        response['command'] = Commands.SMB2_ECHO
+        response['credit_response'] = 3
+        response['flags'].set_flag(Smb2Flags.SMB2_FLAGS_SERVER_TO_REDIR)
+        response['flags'].set_flag(Smb2Flags.SMB2_FLAGS_ASYNC_COMMAND)
+        response['message_id'] = 5
+        response['reserved'] = 0x04030201
+        response['tree_id'] = 0x08070605
+        response['session_id'] = 0xFFFFFFFFFFFFFFFF
+        response['data'] = b"\x04\x00\x00\x00"
+
+        connection._process_message(response.pack())
+
+        assert request.response_event.is_set()
+        assert request.response.pack() == response.pack()
+        assert request.async_id == b"\x01\x02\x03\x04\x05\x06\x07\x08"
+        assert connection.sequence_window_high == 4
+
+    def test_process_message_thread_batch(self, monkeypatch):
+        processed = []
+        connection = Connection(uuid.uuid4(), "server", 445)
+        monkeypatch.setattr(connection, '_process_message', processed.append)
+
+        # Everything queued before the None sentinel is processed and the worker exits without reading any further.
+        msg_queue = deque([b"\x01", b"\x02", None, b"\x03"])
+        msg_event = threading.Event()
+        msg_event.set()
+
+        connection._process_message_thread(msg_queue, msg_event)
+        assert processed == [b"\x01", b"\x02"]
+        assert list(msg_queue) == [b"\x03"]
+        assert not msg_event.is_set()
+
+    def test_verify_signature(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.dialect = Dialects.SMB_3_0_0
+        session = Session(connection, "user", "pass")
+        session.session_id = 1
+        session.signing_key = b"\xff" * 16
+        connection.session_table[1] = session
+
+        header = SMB2HeaderResponse()
+        header['message_id'] = 1
+        header['flags'].set_flag(Smb2Flags.SMB2_FLAGS_SIGNED)
+        header['signature'] = connection._generate_signature(header.pack(), session)
+        connection.verify_signature(header, 1)
+
+        header['signature'] = b"\xff" * 16
+        with pytest.raises(SMBException, match="Server message signature could not be verified"):
+            connection.verify_signature(header, 1)
+
+    def test_send_many(self, monkeypatch):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.transport = RecordingTransport()
+        connection.sequence_window_high = 3
+
+        # The messages are signed/encrypted after the message ids are allocated and the sequence lock is released.
+        build_send_data = connection._build_send_data
+
+        def _build_send_data(*args, **kwargs):
+            assert not connection.sequence_lock.locked()
+            return build_send_data(*args, **kwargs)
+
+        monkeypatch.setattr(connection, '_build_send_data', _build_send_data)
+
+        actual = connection.send_many([SMB2Echo(), SMB2Echo(), SMB2Echo()])
+        assert len(actual) == 3
+        assert [r.message['message_id'].get_value() for r in actual] == [0, 1, 2]
+        assert [connection.outstanding_requests[i] for i in range(3)] == actual
+        assert connection.sequence_window_low == 3
+
+        # Each message is a separate request sent in the one transport call.
+        assert len(connection.transport.sent) == 1
+        assert connection.transport.sent[0] == [r.message.pack() for r in actual]
+
+    def test_send_many_not_enough_credits(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.transport = RecordingTransport()
+        connection.supports_multi_credit = True
+        connection.sequence_window_high = 2
+
+        with pytest.raises(SMBException, match="Request requires 1 credits but only 0 credits are available"):
+            connection.send_many([SMB2Echo(), SMB2Echo(), SMB2Echo()])
+
+        # None of the messages are registered or sent if the batch as a whole does not have enough credits.
+        assert connection.outstanding_requests == {}
+        assert connection.sequence_window_low == 0
+        assert connection.transport.sent == []
+
+    def test_send_many_cancel(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.transport = RecordingTransport()
+        connection.sequence_window_high = 3
+
+        with pytest.raises(ValueError, match="Cannot send an SMB2 CANCEL request with send_many"):
+            connection.send_many([SMB2Echo(), SMB2CancelRequest()])
+
+        assert connection.outstanding_requests == {}
+        assert connection.sequence_window_low == 0
+        assert connection.transport.sent == []
+
+    @pytest.mark.parametrize('cipher_id', [Ciphers.AES_128_CCM, Ciphers.AES_128_GCM])
+    def test_decrypt(self, cipher_id):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        connection.dialect = Dialects.SMB_3_1_1
+        connection.cipher_id = Ciphers.get_cipher(cipher_id)
+        session = Session(connection, "user", "pass")
+        session.session_id = 1
+        session.encryption_key = b"\xff" * 16
+        session.decryption_key = b"\xff" * 16
+        connection.session_table[1] = session
+
+        message = SMB2TransformHeader()
+        message.unpack(connection._encrypt(b"\x01\x02\x03\x04", session))
+
+        actual = connection._decrypt(message)
+        assert actual == b"\x01\x02\x03\x04"
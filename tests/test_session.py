@@ -123,6 +123,21 @@ class TestSMB2Logoff(object):
 
 class TestSession(object):
 
+    def test_reset_key_contexts(self):
+        connection = Connection(uuid.uuid4(), "server", 445)
+        session = Session(connection, "user", "pass")
+        session.signing_context = object()
+        session.encryption_context = object()
+        session.decryption_context = object()
+
+        session.signing_key = b"\x01" * 16
+        session.encryption_key = b"\x02" * 16
+        session.decryption_key = b"\x03" * 16
+
+        assert session.signing_context is None
+        assert session.encryption_context is None
+        assert session.decryption_context is None
+
     def test_dialect_2_0_2(self, smb_real):
         connection = Connection(uuid.uuid4(), smb_real[2], smb_real[3])
         connection.connect(Dialects.SMB_2_0_2)
@@ -134,8 +149,9 @@ class TestSession(object):
             assert session.decryption_key is None
             assert not session.encrypt_data
             assert session.encryption_key is None
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert not session.require_encryption
             assert session.session_id is not None
             assert session.session_key == session.application_key
@@ -155,8 +171,9 @@ class TestSession(object):
             assert session.decryption_key is None
             assert not session.encrypt_data
             assert session.encryption_key is None
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert not session.require_encryption
             assert session.session_id is not None
             assert session.session_key == session.application_key
@@ -178,8 +195,9 @@ class TestSession(object):
             assert session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -202,8 +220,9 @@ class TestSession(object):
             assert session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -226,8 +245,9 @@ class TestSession(object):
             assert session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            assert session.preauth_integrity_hash_value != session.connection.preauth_integrity_hash_value
             assert session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -252,8 +272,13 @@ class TestSession(object):
             assert session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            if session.connection.dialect >= Dialects.SMB_3_1_1:
+                assert session.preauth_integrity_hash_value != session.connection.preauth_integrity_hash_value
+            else:
+                # The session only builds on the connection's preauth integrity hash for SMB 3.1.1.
+                assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -317,8 +342,13 @@ class TestSession(object):
             assert not session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            if session.connection.dialect >= Dialects.SMB_3_1_1:
+                assert session.preauth_integrity_hash_value != session.connection.preauth_integrity_hash_value
+            else:
+                # The session only builds on the connection's preauth integrity hash for SMB 3.1.1.
+                assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert not session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -342,8 +372,13 @@ class TestSession(object):
             assert not session.encrypt_data
             assert len(session.encryption_key) == 16
             assert session.encryption_key != session.session_key
-            assert len(session.connection.preauth_integrity_hash_value) == 2
-            assert len(session.preauth_integrity_hash_value) == 3
+            assert len(session.connection.preauth_integrity_hash_value) == 64
+            assert len(session.preauth_integrity_hash_value) == 64
+            if session.connection.dialect >= Dialects.SMB_3_1_1:
+                assert session.preauth_integrity_hash_value != session.connection.preauth_integrity_hash_value
+            else:
+                # The session only builds on the connection's preauth integrity hash for SMB 3.1.1.
+                assert session.preauth_integrity_hash_value == session.connection.preauth_integrity_hash_value
             assert not session.require_encryption
             assert session.session_id is not None
             assert len(session.session_key) == 16
@@ -1942,7 +1942,7 @@ def test_credit_calculation_with_compound_requests(smb_share):
     assert smbclient.stat(filename).st_size == 0
 
     # Write data that should fit in the credits that we have available.
-    available_credits = connection.sequence_window['high'] - connection.sequence_window['low']
+    available_credits = connection.sequence_window_high - connection.sequence_window_low
     large_length = available_credits * 65536
     with smbclient.open_file(filename, buffering=0, mode='wb') as fd:
         fd.write(b'a' * large_length)
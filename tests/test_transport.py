@@ -4,6 +4,12 @@
 
 import pytest
 import re
+import threading
+import time
+
+from collections import (
+    deque,
+)
 
 from smbprotocol.transport import (
     DirectTCPPacket,
@@ -53,3 +59,51 @@ class TestTcp(object):
         tcp = Tcp("fake-host", 445, None)
         with pytest.raises(ValueError, match=re.escape("Failed to connect to 'fake-host:445': ")):
             tcp.send(b"")
+
+    def test_queue_message(self):
+        recv_queue = deque()
+        tcp = Tcp("0.0.0.0", 0, recv_queue)
+        assert not tcp.recv_event.is_set()
+
+        tcp._queue_message(b"\x01\x02")
+        tcp._queue_message(None)
+        assert tcp.recv_event.is_set()
+        assert list(recv_queue) == [b"\x01\x02", None]
+
+    def test_concurrent_send_not_interleaved(self):
+        class PartialSocket(object):
+            def __init__(self):
+                self.data = b""
+
+            def send(self, data):
+                # Only send 1 byte at a time to give other threads a chance to write in between
+                self.data += data[:1].tobytes()
+                time.sleep(0)
+                return 1
+
+        tcp = Tcp("0.0.0.0", 0, None)
+        tcp._connected = True
+        tcp._sock = PartialSocket()
+
+        threads = [threading.Thread(target=tcp.send, args=(c * 1024,)) for c in [b"\x01", b"\x02"]]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        expected = [b"\x00\x00\x04\x00" + c * 1024 for c in [b"\x01", b"\x02"]]
+        assert tcp._sock.data in [expected[0] + expected[1], expected[1] + expected[0]]
+
+    def test_send_many(self):
+        class RecordingSocket(object):
+            def __init__(self):
+                self.writes = []
+
+            def send(self, data):
+                self.writes.append(data.tobytes())
+                return len(data)
+
+        tcp = Tcp("0.0.0.0", 0, None)
+        tcp._connected = True
+        tcp._sock = RecordingSocket()
+
+        tcp.send_many([b"\x01\x02", b"\x03"])
+        assert tcp._sock.writes == [b"\x00\x00\x00\x02\x01\x02\x00\x00\x00\x01\x03"]